@@ -25,6 +25,9 @@ Options:
   --short-side <pixels>        Resize to this short-side dimension, keep aspect ratio
   --long-side <pixels>         Resize to this long-side dimension, keep aspect ratio
   --pool-size <size>           Number of parallel workers for processing [default: 5]
+  --include <globs>            Comma-separated glob patterns of files to process, e.g. '*.heic,2024/*'
+  --exclude <globs>            Comma-separated glob patterns of files and folders to skip
+  --no-recursive               Only process images directly in DIRECTORY, not in its subfolders
   -d --dry-run                 Show what would be renamed/converted without making changes
   -v --verbose                 Display verbose output including skipped files
   -h --help                    Show this help message and exit
@@ -33,6 +36,8 @@ Notes:
   - If --short-side or --long-side is set, conversion is automatically enabled
   - If converted file is same format as original but <10% smaller, original is copied instead
   - --short-side and --long-side are mutually exclusive
+  - Subfolders are processed too, converted files keep their relative folder in the output folder
+  - The output folder and folders named "out" are never scanned
 
 Date Format Examples:
   %Y%m%d_%H%M%S    20250112_143025
@@ -48,6 +53,7 @@ from docopt import docopt
 from PIL import Image
 from PIL.ExifTags import TAGS
 from pillow_heif import register_heif_opener
+from scan_files import IMAGE_EXTENSIONS, SKIP_DIRS, scan_images
 import re
 from collections import defaultdict
 import uuid
@@ -78,7 +84,7 @@ class ImageFileHandler:
         r'(\d{2})[_\-\.](\d{2})[_\-\.](\d{4})[_\-\s](\d{2}):(\d{2}):(\d{2})',
     ]
     
-    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.heic', '.heif', '.webp', '.tiff')
+    IMAGE_EXTENSIONS = IMAGE_EXTENSIONS
     
     def __init__(self, date_format='%Y%m%d_%H%M%S', verbose=False, rename=False, convert=False, 
                  convert_format='jpg', output_folder='out', quality=85, 
@@ -494,30 +500,36 @@ class ImageFileHandler:
                 return new_path
             counter += 1
     
-    def process_file(self, filename, directory, output_path, dry_run):
+    def process_file(self, filename, directory, output_path, dry_run, file_size=None):
         """
         Process a single image file (called by starmap for parallel processing).
         
         Args:
-            filename: Name of the file to process
+            filename: Path of the file to process, relative to directory ('/' separated)
             directory: Source directory path
             output_path: Output directory path
             dry_run: If True, only show what would be done
+            file_size: File size from the directory scan (stat'ed again if None)
             
         Returns:
-            Tuple of (filename, new_filename, status, original_size, new_size, orig_dims, new_dims, output_lines)
+            Tuple of (filename, new_filename, status, original_size, new_size, orig_dims, new_dims, output_lines),
+            new_filename being relative to directory (or output_path when converting)
         """
         filepath = os.path.join(directory, filename)
-        original_size, original_size_str = self.get_file_size_info(filepath)
+        original_size, original_size_str = self.get_file_size_info(filepath if file_size is None else file_size)
         output_lines = []
         orig_dims = (0, 0)
         new_dims = (0, 0)
+        # Files from subfolders are renamed in place, and converted into the same subfolder of output_path
+        subfolder, name = os.path.split(filename)
         
         try:
-            new_filename = self.generate_new_filename(filepath, filename)
+            new_filename = os.path.join(subfolder, self.generate_new_filename(filepath, name))
             
             if self.convert:
                 output_file_path = os.path.join(output_path, new_filename)
+                if subfolder and not dry_run:
+                    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
             else:
                 output_file_path = os.path.join(directory, new_filename)
             
@@ -532,7 +544,7 @@ class ImageFileHandler:
                         success, new_size, format_changed, copied, orig_dims, new_dims, final_output_path = self.convert_image(filepath, output_file_path, original_size)
                         if success:
                             # Update new_filename to reflect actual output path (may include counter)
-                            new_filename = os.path.basename(final_output_path)
+                            new_filename = os.path.join(subfolder, os.path.basename(final_output_path))
                             _, new_size_str = self.get_file_size_info(final_output_path)
                             status = "CONVERTED" if format_changed or not copied else "COPIED"
                             output_lines.append(f"{status}: {filename}")
@@ -553,7 +565,7 @@ class ImageFileHandler:
                         status = "RENAMED"
                         new_size = original_size
                         # Update new_filename to reflect actual output path
-                        new_filename = os.path.basename(final_output_path)
+                        new_filename = os.path.join(subfolder, os.path.basename(final_output_path))
                         output_lines.append(f"RENAME: {filename}")
                         output_lines.append(f"     -> {new_filename}")
                         
@@ -617,13 +629,16 @@ class ImageFileHandler:
             output_lines.append(f"ERROR: {filename} - {str(e)}")
             return (filename, filename, status, original_size, original_size, orig_dims, new_dims, output_lines)
     
-    def process_directory(self, directory, dry_run=False):
+    def process_directory(self, directory, dry_run=False, recursive=True, include=(), exclude=()):
         """
         Process all images in directory and plan/perform renames and conversions using parallel processing.
         
         Args:
             directory: Path to directory
             dry_run: If True, only show what would be renamed/converted
+            recursive: Also process images in subfolders
+            include: Glob patterns, if any, files must match one of them (see scan_files.scan_images)
+            exclude: Glob patterns of files and folders to skip
             
         Returns:
             List of (old_name, new_name, status, old_size, new_size) tuples
@@ -644,8 +659,12 @@ class ImageFileHandler:
             output_path = directory
         
         results = []
-        files_in_dir = os.listdir(directory)
-        image_files = sorted([f for f in files_in_dir if f.lower().endswith(self.IMAGE_EXTENSIONS)])
+        # Never scan the output folder, it holds converted copies of the input images
+        exclude = tuple(exclude)
+        output_relpath = os.path.relpath(os.path.abspath(output_path), os.path.abspath(directory))
+        if self.convert and output_relpath != '.' and not output_relpath.startswith('..'):
+            exclude += (output_relpath.replace(os.sep, '/'),)
+        image_files = list(scan_images(directory, self.IMAGE_EXTENSIONS, recursive, include, exclude, SKIP_DIRS))
         
         if not image_files:
             print(f"No image files found in {directory}")
@@ -656,7 +675,7 @@ class ImageFileHandler:
         # Use starmap for parallel processing
         with Pool(self.pool_size) as pool:
             # Create arguments for starmap
-            args = [(filename, directory, output_path, dry_run) for filename in image_files]
+            args = [(scanned.relpath, directory, output_path, dry_run, scanned.size) for scanned in image_files]
             
             # Use starmap to process files in parallel
             pool_results = pool.starmap(self.process_file, args)
@@ -734,6 +753,9 @@ def main():
     short_side = args['--short-side']
     long_side = args['--long-side']
     pool_size = args['--pool-size']
+    include = [pattern for pattern in (args['--include'] or '').split(',') if pattern]
+    exclude = [pattern for pattern in (args['--exclude'] or '').split(',') if pattern]
+    recursive = not args['--no-recursive']
 
     # Validate exclusive options
     if short_side and long_side:
@@ -756,7 +778,8 @@ def main():
     if dry_run:
         print(f"DRY-RUN MODE: No files will be modified.\n")
     
-    results = handler.process_directory(directory, dry_run=dry_run)
+    results = handler.process_directory(directory, dry_run=dry_run, recursive=recursive, include=include,
+                                        exclude=exclude)
     handler.print_summary(results)
 
 
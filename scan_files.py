@@ -0,0 +1,115 @@
+"""
+Recursive image file scanning shared by find_duplicates.py and handle_files.py.
+
+Directories are walked with os.scandir, so file types come with the
+directory listing and each file is stat'ed at most once. The stat results
+(mtime, size, inode) are returned along with the paths, so callers don't
+need another os.path.getmtime/getsize call per file.
+"""
+
+import os
+from collections import namedtuple
+from fnmatch import fnmatch
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.heic', '.heif', '.webp', '.tiff')
+
+# Folders never scanned: handle_files.py default output folder, holding converted copies
+SKIP_DIRS = ('out',)
+
+# Files never scanned: index files of find_duplicates.py and their side files
+SKIP_FILES = ('.image_index*',)
+
+# A scanned image file. relpath uses '/' separators, mtime is in seconds as
+# returned by os.path.getmtime, mtime_ns in integer nanoseconds
+ScannedFile = namedtuple('ScannedFile', ['path', 'relpath', 'mtime', 'mtime_ns', 'size', 'inode'])
+
+
+def matches_any(relpath, patterns):
+    """
+    Check a relative path against glob patterns.
+
+    Patterns containing a '/' are matched against the whole relative path,
+    others against the file or folder name only, so '*.png' and '2024/*'
+    both work as expected.
+
+    Args:
+        relpath: Path relative to the scanned directory, with '/' separators
+        patterns: Iterable of fnmatch patterns
+
+    Returns:
+        True if any pattern matches
+    """
+    name = relpath.rsplit('/', 1)[-1]
+    return any(fnmatch(relpath if '/' in pattern else name, pattern) for pattern in patterns)
+
+
+def is_scanned(relpath, extensions=IMAGE_EXTENSIONS, recursive=True, include=(), exclude=(),
+               skip_dirs=SKIP_DIRS):
+    """
+    Check whether scan_images would list a file, if it exists.
+
+    Args:
+        relpath: Path relative to the scanned directory, with '/' separators
+        extensions, recursive, include, exclude, skip_dirs: As for scan_images
+
+    Returns:
+        True if the file passes the same filters as scan_images
+    """
+    exclude = tuple(exclude) + SKIP_FILES
+    folders = relpath.split('/')[:-1]
+    if folders and not recursive:
+        return False
+    for depth, name in enumerate(folders, 1):
+        if name in skip_dirs or matches_any('/'.join(folders[:depth]), exclude):
+            return False
+    if not relpath.lower().endswith(extensions) or matches_any(relpath, exclude):
+        return False
+    return not include or matches_any(relpath, include)
+
+
+def scan_images(directory, extensions=IMAGE_EXTENSIONS, recursive=True, include=(), exclude=(),
+                skip_dirs=SKIP_DIRS):
+    """
+    List image files under a directory, depth-first in sorted name order.
+
+    Args:
+        directory: Directory path
+        extensions: Tuple of valid file extensions (lowercase)
+        recursive: Descend into subfolders
+        include: Glob patterns, if any, a file must match one of them
+        exclude: Glob patterns of files and folders to skip (see matches_any)
+        skip_dirs: Folder names skipped at any depth
+
+    Yields:
+        ScannedFile tuples
+    """
+    exclude = tuple(exclude) + SKIP_FILES
+    pending = [(directory, '')]
+    while pending:
+        folder, prefix = pending.pop()
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Cannot scan {folder}: {e}")
+            continue
+
+        subfolders = []
+        for entry in entries:
+            relpath = prefix + entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and entry.name not in skip_dirs and not matches_any(relpath, exclude):
+                        subfolders.append((entry.path, relpath + '/'))
+                    continue
+                if not entry.name.lower().endswith(extensions) or not entry.is_file():
+                    continue
+                if matches_any(relpath, exclude) or (include and not matches_any(relpath, include)):
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            yield ScannedFile(entry.path, relpath, stat.st_mtime, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+        # Reversed so that the stack pops subfolders in name order
+        pending.extend(reversed(subfolders))